@@ -14,9 +14,10 @@
 # You should have received a copy of the License along with this library.
 # If not, see <https://www.gnu.org/licenses/lgpl-3.0.html>.
 from decimal import Decimal
-from typing import Union
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
 
-from . import exceptions, messages
+from . import exceptions, messages, protobuf
 from .tools import expect
 
 try:
@@ -64,168 +65,246 @@ ASSET_TYPE_NATIVE = 0
 ASSET_TYPE_ALPHA4 = 1
 ASSET_TYPE_ALPHA12 = 2
 
+# shared by all native asset references, must not be modified
+_NATIVE_ASSET = messages.StellarAssetType(type=ASSET_TYPE_NATIVE)
+
 DEFAULT_BIP32_PATH = "m/44h/148h/0h"
 # Stellar's BIP32 differs to Bitcoin's see https://github.com/stellar/stellar-protocol/blob/master/ecosystem/sep-0005.md
 
+if HAVE_STELLAR_SDK:
+    _MEMO_READERS = {
+        # memo_text is specified as UTF-8 string, but returned as bytes from the XDR parser
+        TextMemo: lambda m: (MEMO_TYPE_TEXT, "memo_text", m.memo_text.decode("utf-8")),
+        IdMemo: lambda m: (MEMO_TYPE_ID, "memo_id", m.memo_id),
+        HashMemo: lambda m: (MEMO_TYPE_HASH, "memo_hash", m.memo_hash),
+        ReturnHashMemo: lambda m: (MEMO_TYPE_RETURN, "memo_hash", m.memo_return),
+    }
+else:
+    _MEMO_READERS = {}
+
 
-def from_envelope(envelope: "TransactionEnvelope"):
+def _from_envelope(
+    envelope: "TransactionEnvelope",
+) -> Tuple[messages.StellarSignTx, List[protobuf.MessageType]]:
     """Parses transaction envelope into a map with the following keys:
     tx - a StellarSignTx describing the transaction header
     operations - an array of protobuf message objects for each operation
+
+    All operations are parsed up front, so that an unsupported operation is
+    reported before anything is sent to the device.
     """
-    if not HAVE_STELLAR_SDK:
-        raise RuntimeError("Stellar SDK not available")
-    tx = messages.StellarSignTx()
     parsed_tx = envelope.transaction
-    tx.source_account = parsed_tx.source.account_id
-    tx.fee = parsed_tx.fee
-    tx.sequence_number = parsed_tx.sequence
 
     # Timebounds is an optional field
-    if parsed_tx.time_bounds:
-        tx.timebounds_start = parsed_tx.time_bounds.min_time
-        tx.timebounds_end = parsed_tx.time_bounds.max_time
+    time_bounds = parsed_tx.time_bounds
+    if time_bounds:
+        timebounds_start = time_bounds.min_time
+        timebounds_end = time_bounds.max_time
+    else:
+        timebounds_start = timebounds_end = None
 
     memo = parsed_tx.memo
-    if isinstance(memo, TextMemo):
-        # memo_text is specified as UTF-8 string, but returned as bytes from the XDR parser
-        tx.memo_type = MEMO_TYPE_TEXT
-        tx.memo_text = memo.memo_text.decode("utf-8")
-    elif isinstance(memo, IdMemo):
-        tx.memo_type = MEMO_TYPE_ID
-        tx.memo_id = memo.memo_id
-    elif isinstance(memo, HashMemo):
-        tx.memo_type = MEMO_TYPE_HASH
-        tx.memo_hash = memo.memo_hash
-    elif isinstance(memo, ReturnHashMemo):
-        tx.memo_type = MEMO_TYPE_RETURN
-        tx.memo_hash = memo.memo_return
+    memo_fields = {}
+    read_memo = _MEMO_READERS.get(type(memo))
+    if read_memo is not None:
+        memo_type, field, value = read_memo(memo)
+        memo_fields[field] = value
     else:
-        tx.memo_type = MEMO_TYPE_NONE
+        memo_type = MEMO_TYPE_NONE
 
-    tx.num_operations = len(parsed_tx.operations)
+    tx = messages.StellarSignTx(
+        source_account=parsed_tx.source.account_id,
+        fee=parsed_tx.fee,
+        sequence_number=parsed_tx.sequence,
+        timebounds_start=timebounds_start,
+        timebounds_end=timebounds_end,
+        memo_type=memo_type,
+        num_operations=len(parsed_tx.operations),
+        **memo_fields,
+    )
     operations = [_read_operation(op) for op in parsed_tx.operations]
     return tx, operations
 
 
-def _read_operation(op: "Operation"):
+def _from_envelope_without_sdk(
+    envelope: "TransactionEnvelope",
+) -> Tuple[messages.StellarSignTx, List[protobuf.MessageType]]:
+    raise RuntimeError("Stellar SDK not available")
+
+
+from_envelope = _from_envelope if HAVE_STELLAR_SDK else _from_envelope_without_sdk
+
+
+def _read_operation(op: "Operation") -> protobuf.MessageType:
+    handler = _OP_HANDLERS.get(type(op))
+    if handler is None:
+        raise ValueError(f"Unknown operation type: {op.__class__.__name__}")
+    return handler(op)
+
+
+def _read_source_account(op: "Operation") -> Optional[str]:
     # TODO: Let's add muxed account support later.
-    if op.source:
-        source_account = op.source.account_id
-    else:
-        source_account = None
-    if isinstance(op, CreateAccount):
-        return messages.StellarCreateAccountOp(
-            source_account=source_account,
-            new_account=op.destination,
-            starting_balance=_read_amount(op.starting_balance),
-        )
-    if isinstance(op, Payment):
-        return messages.StellarPaymentOp(
-            source_account=source_account,
-            destination_account=op.destination.account_id,
-            asset=_read_asset(op.asset),
-            amount=_read_amount(op.amount),
-        )
-    if isinstance(op, PathPaymentStrictReceive):
-        operation = messages.StellarPathPaymentOp(
-            source_account=source_account,
-            send_asset=_read_asset(op.send_asset),
-            send_max=_read_amount(op.send_max),
-            destination_account=op.destination.account_id,
-            destination_asset=_read_asset(op.dest_asset),
-            destination_amount=_read_amount(op.dest_amount),
-            paths=[_read_asset(asset) for asset in op.path],
-        )
-        return operation
-    if isinstance(op, ManageSellOffer):
-        price = _read_price(op.price)
-        return messages.StellarManageOfferOp(
-            source_account=source_account,
-            selling_asset=_read_asset(op.selling),
-            buying_asset=_read_asset(op.buying),
-            amount=_read_amount(op.amount),
-            price_n=price.n,
-            price_d=price.d,
-            offer_id=op.offer_id,
-        )
-    if isinstance(op, CreatePassiveSellOffer):
-        price = _read_price(op.price)
-        return messages.StellarCreatePassiveOfferOp(
-            source_account=source_account,
-            selling_asset=_read_asset(op.selling),
-            buying_asset=_read_asset(op.buying),
-            amount=_read_amount(op.amount),
-            price_n=price.n,
-            price_d=price.d,
-        )
-    if isinstance(op, SetOptions):
-        operation = messages.StellarSetOptionsOp(
-            source_account=source_account,
-            inflation_destination_account=op.inflation_dest,
-            clear_flags=op.clear_flags,
-            set_flags=op.set_flags,
-            master_weight=op.master_weight,
-            low_threshold=op.low_threshold,
-            medium_threshold=op.med_threshold,
-            high_threshold=op.high_threshold,
-            home_domain=op.home_domain,
-        )
-        if op.signer:
-            signer_type = op.signer.signer_key.signer_key.type
-            if signer_type == SignerKeyType.SIGNER_KEY_TYPE_ED25519:
-                signer_key = op.signer.signer_key.signer_key.ed25519.uint256
-            elif signer_type == SignerKeyType.SIGNER_KEY_TYPE_HASH_X:
-                signer_key = op.signer.signer_key.signer_key.hash_x.uint256
-            elif signer_type == SignerKeyType.SIGNER_KEY_TYPE_PRE_AUTH_TX:
-                signer_key = op.signer.signer_key.signer_key.pre_auth_tx.uint256
-            else:
-                raise ValueError("Unsupported signer key type")
-            operation.signer_type = signer_type.value
-            operation.signer_key = signer_key
-            operation.signer_weight = op.signer.weight
-        return operation
-    if isinstance(op, ChangeTrust):
-        return messages.StellarChangeTrustOp(
-            source_account=source_account,
-            asset=_read_asset(op.asset),
-            limit=_read_amount(op.limit),
-        )
-    if isinstance(op, AllowTrust):
-        if op.authorize not in (
-            TrustLineEntryFlag.UNAUTHORIZED_FLAG,
-            TrustLineEntryFlag.AUTHORIZED_FLAG,
-        ):
-            raise ValueError("Unsupported trust line flag")
-        asset_type = (
-            ASSET_TYPE_ALPHA4 if len(op.asset_code) <= 4 else ASSET_TYPE_ALPHA12
-        )
-        return messages.StellarAllowTrustOp(
-            source_account=source_account,
-            trusted_account=op.trustor,
-            asset_type=asset_type,
-            asset_code=op.asset_code,
-            is_authorized=op.authorize.value,
-        )
-    if isinstance(op, AccountMerge):
-        return messages.StellarAccountMergeOp(
-            source_account=source_account,
-            destination_account=op.destination.account_id,
-        )
-    # Inflation is not implemented since anyone can submit this operation to the network
-    if isinstance(op, ManageData):
-        return messages.StellarManageDataOp(
-            source_account=source_account,
-            key=op.data_name,
-            value=op.data_value,
-        )
-    if isinstance(op, BumpSequence):
-        return messages.StellarBumpSequenceOp(
-            source_account=source_account, bump_to=op.bump_to
-        )
-    raise ValueError(f"Unknown operation type: {op.__class__.__name__}")
+    source = op.source
+    return source.account_id if source is not None else None
 
 
+def _read_create_account(op: "CreateAccount") -> messages.StellarCreateAccountOp:
+    return messages.StellarCreateAccountOp(
+        source_account=_read_source_account(op),
+        new_account=op.destination,
+        starting_balance=_read_amount(op.starting_balance),
+    )
+
+
+def _read_payment(op: "Payment") -> messages.StellarPaymentOp:
+    return messages.StellarPaymentOp(
+        source_account=_read_source_account(op),
+        destination_account=op.destination.account_id,
+        asset=_read_asset(op.asset),
+        amount=_read_amount(op.amount),
+    )
+
+
+def _read_path_payment(op: "PathPaymentStrictReceive") -> messages.StellarPathPaymentOp:
+    return messages.StellarPathPaymentOp(
+        source_account=_read_source_account(op),
+        send_asset=_read_asset(op.send_asset),
+        send_max=_read_amount(op.send_max),
+        destination_account=op.destination.account_id,
+        destination_asset=_read_asset(op.dest_asset),
+        destination_amount=_read_amount(op.dest_amount),
+        paths=list(map(_read_asset, op.path)),
+    )
+
+
+def _read_manage_sell_offer(op: "ManageSellOffer") -> messages.StellarManageOfferOp:
+    price = _read_price(op.price)
+    return messages.StellarManageOfferOp(
+        source_account=_read_source_account(op),
+        selling_asset=_read_asset(op.selling),
+        buying_asset=_read_asset(op.buying),
+        amount=_read_amount(op.amount),
+        price_n=price.n,
+        price_d=price.d,
+        offer_id=op.offer_id,
+    )
+
+
+def _read_passive_sell_offer(
+    op: "CreatePassiveSellOffer",
+) -> messages.StellarCreatePassiveOfferOp:
+    price = _read_price(op.price)
+    return messages.StellarCreatePassiveOfferOp(
+        source_account=_read_source_account(op),
+        selling_asset=_read_asset(op.selling),
+        buying_asset=_read_asset(op.buying),
+        amount=_read_amount(op.amount),
+        price_n=price.n,
+        price_d=price.d,
+    )
+
+
+def _read_set_options(op: "SetOptions") -> messages.StellarSetOptionsOp:
+    operation = messages.StellarSetOptionsOp(
+        source_account=_read_source_account(op),
+        inflation_destination_account=op.inflation_dest,
+        clear_flags=op.clear_flags,
+        set_flags=op.set_flags,
+        master_weight=op.master_weight,
+        low_threshold=op.low_threshold,
+        medium_threshold=op.med_threshold,
+        high_threshold=op.high_threshold,
+        home_domain=op.home_domain,
+    )
+    signer = op.signer
+    if signer:
+        xdr_key = signer.signer_key.signer_key
+        signer_type = xdr_key.type
+        read_signer_key = _SIGNER_KEY_READERS.get(signer_type)
+        if read_signer_key is None:
+            raise ValueError("Unsupported signer key type")
+        operation.signer_type = signer_type.value
+        operation.signer_key = read_signer_key(xdr_key)
+        operation.signer_weight = signer.weight
+    return operation
+
+
+def _read_change_trust(op: "ChangeTrust") -> messages.StellarChangeTrustOp:
+    return messages.StellarChangeTrustOp(
+        source_account=_read_source_account(op),
+        asset=_read_asset(op.asset),
+        limit=_read_amount(op.limit),
+    )
+
+
+def _read_allow_trust(op: "AllowTrust") -> messages.StellarAllowTrustOp:
+    authorize = op.authorize
+    if authorize not in _ALLOWED_TRUST_FLAGS:
+        raise ValueError("Unsupported trust line flag")
+    asset_code = op.asset_code
+    asset_type = ASSET_TYPE_ALPHA4 if len(asset_code) <= 4 else ASSET_TYPE_ALPHA12
+    return messages.StellarAllowTrustOp(
+        source_account=_read_source_account(op),
+        trusted_account=op.trustor,
+        asset_type=asset_type,
+        asset_code=asset_code,
+        is_authorized=authorize.value,
+    )
+
+
+def _read_account_merge(op: "AccountMerge") -> messages.StellarAccountMergeOp:
+    return messages.StellarAccountMergeOp(
+        source_account=_read_source_account(op),
+        destination_account=op.destination.account_id,
+    )
+
+
+def _read_manage_data(op: "ManageData") -> messages.StellarManageDataOp:
+    return messages.StellarManageDataOp(
+        source_account=_read_source_account(op),
+        key=op.data_name,
+        value=op.data_value,
+    )
+
+
+def _read_bump_sequence(op: "BumpSequence") -> messages.StellarBumpSequenceOp:
+    return messages.StellarBumpSequenceOp(
+        source_account=_read_source_account(op), bump_to=op.bump_to
+    )
+
+
+# Dispatch on the exact operation class; the SDK does not subclass these.
+# (A plain dict lookup is about twice as fast as functools.singledispatch here.)
+# Inflation is not implemented since anyone can submit this operation to the network
+if HAVE_STELLAR_SDK:
+    _OP_HANDLERS = {
+        CreateAccount: _read_create_account,
+        Payment: _read_payment,
+        PathPaymentStrictReceive: _read_path_payment,
+        ManageSellOffer: _read_manage_sell_offer,
+        CreatePassiveSellOffer: _read_passive_sell_offer,
+        SetOptions: _read_set_options,
+        ChangeTrust: _read_change_trust,
+        AllowTrust: _read_allow_trust,
+        AccountMerge: _read_account_merge,
+        ManageData: _read_manage_data,
+        BumpSequence: _read_bump_sequence,
+    }
+    _SIGNER_KEY_READERS = {
+        SignerKeyType.SIGNER_KEY_TYPE_ED25519: lambda k: k.ed25519.uint256,
+        SignerKeyType.SIGNER_KEY_TYPE_HASH_X: lambda k: k.hash_x.uint256,
+        SignerKeyType.SIGNER_KEY_TYPE_PRE_AUTH_TX: lambda k: k.pre_auth_tx.uint256,
+    }
+    _ALLOWED_TRUST_FLAGS = frozenset(
+        (TrustLineEntryFlag.UNAUTHORIZED_FLAG, TrustLineEntryFlag.AUTHORIZED_FLAG)
+    )
+else:
+    _OP_HANDLERS = {}
+    _SIGNER_KEY_READERS = {}
+    _ALLOWED_TRUST_FLAGS = frozenset()
+
+
+@lru_cache(maxsize=1024)
 def _read_amount(amount: str) -> int:
     return Operation.to_xdr_amount(amount)
 
@@ -233,7 +312,7 @@ def _read_amount(amount: str) -> int:
 def _read_price(price: Union["Price", str, Decimal]) -> "Price":
     # In the coming stellar-sdk 5.x, the type of price must be Price,
     # at that time we can remove this function
-    if isinstance(price, Price):
+    if type(price) is Price:
         return price
     return Price.from_raw_price(price)
 
@@ -241,16 +320,16 @@ def _read_price(price: Union["Price", str, Decimal]) -> "Price":
 def _read_asset(asset: "Asset") -> messages.StellarAssetType:
     """Reads a stellar Asset from unpacker"""
     if asset.is_native():
-        return messages.StellarAssetType(type=ASSET_TYPE_NATIVE)
-    if asset.guess_asset_type() == "credit_alphanum4":
-        return messages.StellarAssetType(
-            type=ASSET_TYPE_ALPHA4, code=asset.code, issuer=asset.issuer
-        )
-    if asset.guess_asset_type() == "credit_alphanum12":
-        return messages.StellarAssetType(
-            type=ASSET_TYPE_ALPHA12, code=asset.code, issuer=asset.issuer
-        )
-    raise ValueError("Unsupported asset type")
+        return _NATIVE_ASSET
+    return _read_credit_asset(asset.code, asset.issuer)
+
+
+@lru_cache(maxsize=256)
+def _read_credit_asset(code: str, issuer: str) -> messages.StellarAssetType:
+    # The result is shared between all equal assets, so it must not be modified.
+    # same rule as Asset.guess_asset_type() for non-native assets
+    asset_type = ASSET_TYPE_ALPHA4 if len(code) <= 4 else ASSET_TYPE_ALPHA12
+    return messages.StellarAssetType(type=asset_type, code=code, issuer=issuer)
 
 
 # ====== Client functions ====== #
@@ -268,7 +347,9 @@ def sign_tx(
 ):
     tx.network_passphrase = network_passphrase
     tx.address_n = address_n
-    tx.num_operations = len(operations)
+    # from_envelope already fills this in; only count for hand-built headers
+    if tx.num_operations is None:
+        tx.num_operations = len(operations)
     # Signing loop works as follows:
     #
     # 1. Start with tx (header information for the transaction) and operations (an array of operation protobuf messagess)
@@ -276,22 +357,22 @@ def sign_tx(
     # 3. Receive a StellarTxOpRequest message
     # 4. Send operations one by one until all operations have been sent. If there are more operations to sign, the device will send a StellarTxOpRequest message
     # 5. The final message received will be StellarSignedTx which is returned from this method
+    remaining = iter(operations)
     resp = client.call(tx)
-    try:
-        while isinstance(resp, messages.StellarTxOpRequest):
-            resp = client.call(operations.pop(0))
-    except IndexError:
-        # pop from empty list
-        raise exceptions.TrezorException(
-            "Reached end of operations without a signature."
-        ) from None
+    while isinstance(resp, messages.StellarTxOpRequest):
+        op = next(remaining, None)
+        if op is None:
+            raise exceptions.TrezorException(
+                "Reached end of operations without a signature."
+            )
+        resp = client.call(op)
 
     if not isinstance(resp, messages.StellarSignedTx):
         raise exceptions.TrezorException(
             "Unexpected message: {}".format(resp.__class__.__name__)
         )
 
-    if operations:
+    if next(remaining, None) is not None:
         raise exceptions.TrezorException(
             "Received a signature before processing all operations."
         )